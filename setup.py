@@ -55,7 +55,7 @@ extras_require = {
 
 setup(
     name="social-interaction-cloud",
-    version="2.0.20",
+    version="2.1.0",
     author="Koen Hindriks",
     author_email="k.v.hindriks@vu.nl",
     long_description=open("README.md").read(),
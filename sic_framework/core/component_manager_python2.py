@@ -1,14 +1,12 @@
-import copy
 import threading
 import time
 from signal import SIGINT, SIGTERM, signal
 from sys import exit
 
+import six
+
 import sic_framework.core.sic_logging
-from sic_framework.core.utils import (
-    MAGIC_STARTED_COMPONENT_MANAGER_TEXT,
-    is_sic_instance,
-)
+from sic_framework.core.utils import MAGIC_STARTED_COMPONENT_MANAGER_TEXT
 
 from . import sic_logging, utils
 from .message_python2 import (
@@ -56,21 +54,38 @@ class SICComponentManager(object):
         self.redis = SICRedis()
         self.ip = utils.get_ip_adress()
 
-        self.active_components = []
+        # component name -> the last started instance of that component, and the thread running its start()
+        self.active_components = {}
+        self._component_threads = {}
         self.component_classes = {
             cls.get_component_name(): cls for cls in component_classes
         }
+        # component name -> lock held while starting that component, such that concurrent requests for the same
+        # component start a single instance, while different components can still start at the same time
+        self._component_locks = {
+            name: threading.Lock() for name in self.component_classes
+        }
         self.component_counter = 0
 
+        # request message name -> function handling that type of request
+        self._request_handlers = {
+            SICStopRequest.get_message_name(): self._handle_stop_request,
+            SICStartComponentRequest.get_message_name(): self._handle_start_component_request,
+        }
+
         self.stop_event = threading.Event()
-        self.ready_event = threading.Event()
+        # set once when the manager is done setting up, never waited on so a flag suffices
+        self.ready = False
 
         self.logger = self.get_manager_logger()
         self.redis.parent_logger = self.logger
 
         # The _handle_request function is calls execute directly, as we must reply when execution done to allow the user
-        # to wait for this. New messages will be buffered by redis. The component manager listens to
-        self.redis.register_request_handler(self.ip, self._handle_request)
+        # to wait for this. Requests are handled concurrently, such that starting several components at once only
+        # takes as long as the slowest component instead of the sum of their startup times.
+        self.redis.register_request_handler(
+            self.ip, self._handle_request, concurrent=True
+        )
 
         # TODO FIXME
         # self._sync_time()
@@ -82,7 +97,7 @@ class SICComponentManager(object):
         for c in self.component_classes.values():
             self.logger.info(" - {}".format(c.get_component_name()))
 
-        self.ready_event.set()
+        self.ready = True
         if auto_serve:
             self.serve()
 
@@ -90,17 +105,19 @@ class SICComponentManager(object):
         """
         Listen for requests until this component manager is signaled to stop running.
         """
-        # wait for the signal to stop, loop is necessary for ctrl-c to work on python2
+        # wait for the signal to stop. On python3 a blocking wait is interrupted by ctrl-c (KeyboardInterrupt), on
+        # python2 acquiring a lock cannot be interrupted so the loop is necessary for ctrl-c to work
         try:
-            while True:
-                self.stop_event.wait(timeout=0.1)
-                if self.stop_event.is_set():
-                    break
+            if six.PY3:
+                self.stop_event.wait()
+            else:
+                while not self.stop_event.is_set():
+                    self.stop_event.wait(timeout=0.1)
         except KeyboardInterrupt:
             pass
 
         self.stop()
-        print("Stopped component manager.")
+        self.logger.info("Stopped component manager.")
 
     def _sync_time(self):
         """
@@ -129,34 +146,42 @@ class SICComponentManager(object):
 
     def _handle_request(self, request):
         """
-        Start a component on this device as requested by a user. A thread is started to run the component, and component
-        threads are restarted/reused when a user re-requests the component. Separated such that SICSingletonFactory can
-        override this method.
-        :param request: The SICStartServiceRequest request
+        Handle a request from a user, e.g. to start a component on this device. A thread is started to run the component,
+        and component threads are restarted/reused when a user re-requests the component. Separated such that
+        SICSingletonFactory can override this method.
+        :param request: The SICStartComponentRequest or SICStopRequest request
         """
 
-        if is_sic_instance(request, SICStopRequest):
-            self.stop_event.set()
-            # return an empty stop message as a request must always be replied to
-            return SICSuccessMessage()
+        # pick the handler for this type of request with a single lookup, ignore any other requests
+        handler = self._request_handlers.get(request.get_message_name())
+        if handler is None:
+            return SICIgnoreRequestMessage()
 
-        # reply to the request if the component manager can start the component
-        if request.component_name in self.component_classes:
-            print(
-                "{} handling request {}".format(
-                    self.__class__.__name__, request.component_name
-                )
-            )
+        return handler(request)
 
-            return self.start_component(request)
-        else:
-            print(
+    def _handle_stop_request(self, request):
+        self.stop_event.set()
+        # return an empty stop message as a request must always be replied to
+        return SICSuccessMessage()
+
+    def _handle_start_component_request(self, request):
+        # reply to the request if the component manager can start the component
+        if request.component_name not in self.component_classes:
+            self.logger.debug(
                 "{} ignored request {}".format(
                     self.__class__.__name__, request.component_name
                 )
             )
             return SICIgnoreRequestMessage()
 
+        self.logger.info(
+            "{} handling request {}".format(
+                self.__class__.__name__, request.component_name
+            )
+        )
+
+        return self.start_component(request)
+
     def get_manager_logger(self, log_level=sic_logging.INFO):
         """
         Create a logger to inform the user during the setup of the component by the manager.
@@ -165,6 +190,8 @@ class SICComponentManager(object):
         name = "{manager}".format(manager=self.__class__.__name__)
 
         logger = sic_logging.get_sic_logger(self.redis, name, log_level)
+        # do not keep requests waiting for log messages to be written
+        sic_logging.handle_in_background(logger)
         logger.info("Manager on device {} starting".format(self.ip))
 
         return logger
@@ -177,59 +204,94 @@ class SICComponentManager(object):
         :return: the SICStartedServiceInformation with the information to connect to the started component.
         """
 
-        component_class = self.component_classes[request.component_name]  # SICComponent
-
-        component = None
-        try:
-            stop_event = threading.Event()
-            ready_event = threading.Event()
-            component = component_class(
-                stop_event=stop_event,
-                ready_event=ready_event,
-                log_level=request.log_level,
-                conf=request.conf,
-            )
-            self.active_components.append(component)
+        with self._component_locks[request.component_name]:
+            return self._start_component(request)
 
-            # TODO daemon=False could be set to true, but then the component cannot clean up properly
-            # but also not available in python2
-            thread = threading.Thread(target=component._start)
-            thread.name = component_class.get_component_name()
-            thread.start()
-
-            # wait till the component is ready to receive input
-            component._ready_event.wait(component.COMPONENT_STARTUP_TIMEOUT)
+    def _start_component(self, request):
+        component_class = self.component_classes[request.component_name]  # SICComponent
 
-            if component._ready_event.is_set() is False:
-                self.logger.error(
-                    "Component {} refused to start within {} seconds!".format(
-                        component.get_component_name(),
-                        component.COMPONENT_STARTUP_TIMEOUT,
+        # reuse the component if it is still running, instead of starting a second instance of it
+        component = self.active_components.get(request.component_name)
+        if component is not None and not component._stop_event.is_set():
+            thread = self._component_threads[request.component_name]
+            # it might still be starting, a second instance would not be stopped by the manager
+            if thread.is_alive():
+                component._ready_event.wait(component.COMPONENT_STARTUP_TIMEOUT)
+
+            if component._ready_event.is_set():
+                # always a new reply instead of a cached (copied) one, the request id is set on it when replying
+                return SICSuccessMessage()
+
+            if thread.is_alive():
+                return SICNotStartedMessage(
+                    "Component {} is still starting".format(
+                        component.get_component_name()
                     )
                 )
-                # Todo do something!
 
-            # inform the user their component has started
-            reply = SICSuccessMessage()
+            # start() failed, it is safe to stop it and replace it with a new instance
+            component.stop()
 
-            return reply
+        # a component fails in its constructor when e.g. its device or a dependency is not available
+        try:
+            component = self._create_component(component_class, request)
+        except Exception as e:
+            self.logger.exception(e)
+            return SICNotStartedMessage(e)
+        self.active_components[request.component_name] = component
 
+        # TODO daemon=False could be set to true, but then the component cannot clean up properly
+        # but also not available in python2
+        thread = threading.Thread(target=component._start)
+        thread.name = component_class.get_component_name()
+        self._component_threads[request.component_name] = thread
+        try:
+            thread.start()
         except Exception as e:
-            self.logger.exception(
-                e
-            )  # maybe not needed if already sending back a not started message
-            if component is not None:
-                component.stop()
+            # e.g. the device cannot start any more threads
+            self.logger.exception(e)
+            component.stop()
             return SICNotStartedMessage(e)
 
+        # wait till the component is ready to receive input
+        component._ready_event.wait(component.COMPONENT_STARTUP_TIMEOUT)
+
+        if not component._ready_event.is_set():
+            message = "Component {} refused to start within {} seconds!".format(
+                component.get_component_name(),
+                component.COMPONENT_STARTUP_TIMEOUT,
+            )
+            self.logger.error(message)
+            # do not stop it while it is still starting, it is reused once it is ready
+            return SICNotStartedMessage(message)
+
+        # inform the user their component has started
+        return SICSuccessMessage()
+
+    def _create_component(self, component_class, request):
+        """
+        Instantiate a component as requested by a user. Any exception raised by the component is passed on.
+        :param component_class: The SICComponent class to instantiate
+        :param request: The SICStartComponentRequest request
+        :return: the component
+        """
+        return component_class(
+            stop_event=threading.Event(),
+            ready_event=threading.Event(),
+            log_level=request.log_level,
+            conf=request.conf,
+        )
+
     def stop(self, *args):
         self.stop_event.set()
-        print("Trying to exit manager gracefully...")
+        self.logger.info("Trying to exit manager gracefully...")
         try:
+            # send the messages components send when stopping, e.g. log messages, in a single round trip
+            with self.redis.pipeline():
+                for component in list(self.active_components.values()):
+                    component.stop()
+                    # component._stop_event.set()
             self.redis.close()
-            for component in self.active_components:
-                component.stop()
-                # component._stop_event.set()
-            print("Graceful exit was successful")
+            self.logger.info("Graceful exit was successful")
         except Exception as err:
-            print("Graceful exit has failed: {}".format(err))
+            self.logger.error("Graceful exit has failed: {}".format(err))
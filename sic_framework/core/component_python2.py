@@ -53,7 +53,8 @@ class SICComponent:
         self._stop_event = stop_event if stop_event else threading.Event()
 
         self._input_channels = []
-        self._output_channel = self.get_output_channel(self._ip)
+        # encoded once, as redis would otherwise encode the channel name again for every output message
+        self._output_channel = utils.ensure_binary(self.get_output_channel(self._ip))
 
         self.params = None
 
@@ -133,8 +133,8 @@ class SICConnector(object):
         except TimeoutError as e:
             six.raise_from(
                 TimeoutError(
-                    "Could not connect to {}. Is SIC running on the device (ip:{})?".format(
-                        self.component_class.get_component_name(), self._ip
+                    "Could not connect to {}. Is SIC running on the device (ip:{})? ({})".format(
+                        self.component_class.get_component_name(), self._ip, e
                     )
                 ),
                 None,
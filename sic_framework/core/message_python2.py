@@ -138,9 +138,18 @@ class SICMessage(object):
         with support for numpy arrays.
         :return: 'bytes' in python3, 'str' in python2 (which are roughly the same)
         """
-        self.__NP_VALUES = []
-        self.__JPEG_VALUES = []
-        self.__SIC_MESSAGES = []
+        # Forget the bookkeeping of a previous serialization. Only non-empty lists are stored on the message, empty
+        # lists fall back to the class attributes. This keeps three empty lists out of the pickle of most messages.
+        for attr in (
+            "_SICMessage__NP_VALUES",
+            "_SICMessage__JPEG_VALUES",
+            "_SICMessage__SIC_MESSAGES",
+        ):
+            self.__dict__.pop(attr, None)
+
+        np_values = []
+        jpeg_values = []
+        sic_messages = []
 
         # Compress np arrays with np.save
         for attr in vars(self):
@@ -148,7 +157,7 @@ class SICMessage(object):
 
             if isinstance(attr_value, SICMessage):
                 setattr(self, attr, attr_value.serialize())
-                self.__SIC_MESSAGES.append(attr)
+                sic_messages.append(attr)
             elif isinstance(attr_value, np.ndarray):
                 if (
                     self._compress_images
@@ -156,10 +165,17 @@ class SICMessage(object):
                     and attr_value.shape[-1] == 3
                 ):
                     setattr(self, attr, self.np2jpeg(attr_value))
-                    self.__JPEG_VALUES.append(attr)
+                    jpeg_values.append(attr)
                 else:
                     setattr(self, attr, self._np2base(attr_value))
-                    self.__NP_VALUES.append(attr)
+                    np_values.append(attr)
+
+        if np_values:
+            self.__NP_VALUES = np_values
+        if jpeg_values:
+            self.__JPEG_VALUES = jpeg_values
+        if sic_messages:
+            self.__SIC_MESSAGES = sic_messages
 
         # Pickle dataclass
         return pickle.dumps(self, protocol=2)
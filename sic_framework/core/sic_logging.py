@@ -1,9 +1,13 @@
 from __future__ import print_function
 
+import atexit
 import io
 import logging
 import threading
 
+import six
+from six.moves import queue
+
 from . import utils
 from .message_python2 import SICMessage
 from .sic_redis import SICRedis
@@ -140,6 +144,37 @@ def get_sic_logger(redis, name, log_level):
     return logger
 
 
+def handle_in_background(logger, maxsize=1024):
+    """
+    Move the handlers of a logger to a background thread, such that logging only puts the message in a queue and does
+    not wait for writing it to the terminal and redis. Messages are dropped (and reported) when the queue is full.
+    Only available on python3, on python2 the logger is left as is.
+
+    :param logger: A logger created with get_sic_logger
+    :param maxsize: The maximum number of messages waiting to be handled
+    """
+    if not six.PY3:
+        return
+
+    from logging.handlers import QueueHandler, QueueListener
+
+    log_queue = queue.Queue(maxsize=maxsize)
+
+    # The queue handler formats the message before putting it in the queue (which also renders the exception
+    # information), so the handlers in the background only need to write the formatted message.
+    handler_queue = QueueHandler(log_queue)
+    handler_queue.setFormatter(logger.handlers[0].formatter)
+    for handler in logger.handlers:
+        handler.setFormatter(logging.Formatter("%(message)s"))
+
+    listener = QueueListener(log_queue, *logger.handlers)
+    logger.handlers = [handler_queue]
+    listener.start()
+
+    # write any remaining messages before exiting
+    atexit.register(listener.stop)
+
+
 # Loglevel interpretation
 # mostly follows python's defaults
 
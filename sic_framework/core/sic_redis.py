@@ -31,6 +31,8 @@ import atexit
 import os
 import threading
 import time
+import traceback
+from contextlib import contextmanager
 
 import redis
 import six
@@ -42,10 +44,141 @@ from sic_framework.core.utils import is_sic_instance
 
 
 class CallbackThread:
-    def __init__(self, function, pubsub, thread):
+    def __init__(self, function, pubsub, thread, channels):
         self.function = function
+        # the pubsub shared by all handlers using the same connection pool, see _SubscriptionDispatcher
         self.pubsub = pubsub
         self.thread = thread
+        self.channels = channels
+
+
+class HandlerThread(threading.Thread):
+    """
+    A thread that runs a message or request handler for every pubsub message passed to it by the
+    _SubscriptionDispatcher. Handling messages in a thread per handler keeps a slow handler from blocking the messages
+    for other handlers, while the messages for a single handler are still handled in order.
+    """
+
+    # The maximum number of requests a concurrent handler handles at once, further requests wait for a free thread
+    MAX_CONCURRENT_REQUESTS = max(4, 2 * utils.get_num_cpus())
+
+    def __init__(self, function, concurrent=False):
+        super(HandlerThread, self).__init__()
+        self.function = function
+        self.concurrent = concurrent
+        self.queue = queue.Queue()
+        self._free_workers = threading.BoundedSemaphore(self.MAX_CONCURRENT_REQUESTS)
+
+    def run(self):
+        while True:
+            pubsub_msg = self.queue.get()
+            if pubsub_msg is None:
+                break
+
+            if self.concurrent:
+                self._free_workers.acquire()
+                thread = threading.Thread(target=self._work, args=(pubsub_msg,))
+                thread.name = "{}_worker".format(self.name)
+                thread.start()
+            else:
+                self.function(pubsub_msg)
+
+    def _work(self, pubsub_msg):
+        try:
+            self.function(pubsub_msg)
+        finally:
+            self._free_workers.release()
+
+    def stop(self):
+        self.queue.put(None)
+
+
+class _SubscriptionDispatcher(object):
+    """
+    A single pubsub connection and listener thread shared by all message and request handlers using the same
+    connection pool, instead of a connection and listener per handler. Messages are routed to the handlers of their
+    channel. Use _get_dispatcher to get the dispatcher of a connection pool.
+    """
+
+    def __init__(self, connection_pool):
+        self._lock = threading.Lock()
+        # Use a pool of our own, as the SICRedis instances using the original pool might be closed before the
+        # other handlers are done.
+        self._connection_pool = redis.ConnectionPool(
+            connection_class=connection_pool.connection_class,
+            **connection_pool.connection_kwargs
+        )
+        self._pubsub = None
+        self._thread = None
+        # channel name -> HandlerThreads listening to that channel
+        self._handlers = {}
+
+    def register(self, channels, handler_thread):
+        with self._lock:
+            if self._pubsub is None:
+                self._pubsub = redis.Redis(
+                    connection_pool=self._connection_pool
+                ).pubsub(ignore_subscribe_messages=True)
+
+            channels = set(channels)
+            new_channels = [c for c in channels if c not in self._handlers]
+            for channel in channels:
+                self._handlers.setdefault(channel, []).append(handler_thread)
+            if new_channels:
+                self._pubsub.subscribe(**{c: self._dispatch for c in new_channels})
+
+            if self._thread is None:
+                self._thread = self._pubsub.run_in_thread(sleep_time=0.1, daemon=False)
+                self._thread.name = "SICSubscriptionDispatcher"
+
+            return self._pubsub
+
+    def unregister(self, channels, handler_thread):
+        with self._lock:
+            for channel in set(channels):
+                handlers = self._handlers.get(channel, [])
+                if handler_thread in handlers:
+                    handlers.remove(handler_thread)
+
+                if not handlers and channel in self._handlers:
+                    del self._handlers[channel]
+                    self._pubsub.unsubscribe(channel)
+
+            # stop listening when the last handler is gone, the thread closes the pubsub connection
+            if not self._handlers and self._thread is not None:
+                self._thread.stop()
+                self._thread = None
+                self._pubsub = None
+
+    def _dispatch(self, pubsub_msg):
+        channel = utils.str_if_bytes(pubsub_msg["channel"])
+        # the queues are not bounded so putting never blocks, and holding the lock ensures a handler gets no more
+        # messages once unregistered
+        with self._lock:
+            for handler_thread in self._handlers.get(channel, []):
+                handler_thread.queue.put(pubsub_msg)
+
+
+# id of a connection pool -> (the pool, its _SubscriptionDispatcher), the pool is kept such that its id is not reused
+_dispatchers = {}
+_dispatchers_lock = threading.Lock()
+
+
+def _get_dispatcher(connection_pool):
+    """
+    Get the dispatcher for all subscriptions on a connection pool, such that every redis server gets its own
+    subscriber.
+    :param connection_pool: The redis.ConnectionPool of a SICRedis instance
+    :return: The _SubscriptionDispatcher
+    """
+    with _dispatchers_lock:
+        key = id(connection_pool)
+        if key not in _dispatchers:
+            _dispatchers[key] = (
+                connection_pool,
+                _SubscriptionDispatcher(connection_pool),
+            )
+        return _dispatchers[key][1]
 
 
 # keep track of all redis instances, so we can close them on exit
@@ -76,6 +209,64 @@ def get_redis_db_ip_password():
     return host, password
 
 
+# A single byte appended to every message sent on a pubsub channel, such that receivers can tell requests from other
+# messages without unpickling them. It is appended rather than prepended, as pickle ignores any bytes after the pickled
+# object, which saves copying the (possibly large) message to strip the tag.
+MESSAGE_TAG = b"\x00"
+REQUEST_TAG = b"\x01"
+
+# The oldest version of social-interaction-cloud using the same request/reply protocol as this version
+MIN_COMPATIBLE_VERSION = "2.1.0"
+
+# set once a message from an older SIC version is received, to only warn about it once
+_warned_untagged = False
+
+# holds the pipeline of a thread that is batching its messages, see SICRedis.pipeline()
+_pipelines = threading.local()
+
+# connection pool shared by all SICRedis instances in this process, created on first use
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+
+def get_connection_pool():
+    """
+    Get the redis connection pool shared by all SICRedis instances in this process, such that every component and
+    connector reuses idle connections instead of opening a new one.
+
+    The pool is not bounded, as every subscription holds on to a connection for as long as it is subscribed and
+    a full pool would raise an error instead of waiting.
+    """
+    global _connection_pool
+
+    with _connection_pool_lock:
+        if _connection_pool is None:
+            # we assume that a password is required
+            host, password = get_redis_db_ip_password()
+
+            # Let's try to connect first without TLS / working without TLS facilitates simple use of redis-cli
+            try:
+                r = redis.Redis(host=host, ssl=False, password=password)
+            except redis.exceptions.AuthenticationError:
+                # redis is running without a password, do not supply it.
+                r = redis.Redis(host=host, ssl=False)
+            except redis.exceptions.ConnectionError as e:
+                # Must be a connection error; so now let's try to connect with TLS
+                ssl_ca_certs = os.path.join(os.path.dirname(__file__), "cert.pem")
+                print(
+                    "TLS required. Looking for certificate here:",
+                    ssl_ca_certs,
+                    "(Source error {})".format(e),
+                )
+                r = redis.Redis(
+                    host=host, ssl=True, ssl_ca_certs=ssl_ca_certs, password=password
+                )
+
+            _connection_pool = r.connection_pool
+
+    return _connection_pool
+
+
 class SICRedis:
     """
     A custom version of redis, that more transparently handles the type of communication necessary for SIC. The aim
@@ -85,41 +276,30 @@ class SICRedis:
     this is ignored by this extension. Using any other redis functions 'as is' is discouraged.
     """
 
-    def __init__(self, parent_name=None):
+    # Number of seconds a reply to a request is kept when the requesting client is no longer waiting for it
+    REPLY_EXPIRE_TIME = 60
+
+    def __init__(self, parent_name=None, connection_pool=None):
         """
         :param parent_name: The name of the module that uses this redis connection, for easier debugging
+        :param connection_pool: The redis.ConnectionPool to take connections from, defaults to the pool shared by
+                                all SICRedis instances in this process.
         """
 
         self.stopping = False
         self._running_callbacks = []
 
-        # we assume that a password is required
-        host, password = get_redis_db_ip_password()
+        if connection_pool is None:
+            connection_pool = get_connection_pool()
 
-        # Let's try to connect first without TLS / working without TLS facilitates simple use of redis-cli
-        try:
-            self._redis = redis.Redis(host=host, ssl=False, password=password)
-        except redis.exceptions.AuthenticationError:
-            # redis is running without a password, do not supply it.
-            self._redis = redis.Redis(host=host, ssl=False)
-        except redis.exceptions.ConnectionError as e:
-            # Must be a connection error; so now let's try to connect with TLS
-            ssl_ca_certs = os.path.join(os.path.dirname(__file__), "cert.pem")
-            print(
-                "TLS required. Looking for certificate here:",
-                ssl_ca_certs,
-                "(Source error {})".format(e),
-            )
-            self._redis = redis.Redis(
-                host=host, ssl=True, ssl_ca_certs=ssl_ca_certs, password=password
-            )
+        self._redis = redis.Redis(connection_pool=connection_pool)
 
         try:
             self._redis.ping()
         except redis.exceptions.ConnectionError:
             e = Exception(
                 "Could not connect to redis at {} \n\n Have you started redis? Use: `redis-server conf/redis/redis.conf`".format(
-                    host
+                    connection_pool.connection_kwargs.get("host")
                 )
             )
             # six.raise_from(e, None) # unsupported on some peppers
@@ -135,8 +315,9 @@ class SICRedis:
 
     def register_message_handler(self, channels, callback, ignore_requests=True):
         """
-        Subscribe a callback function to one or more channels, and also start a thread to monitor for new messages.
-        By default, ignores SICRequests.
+        Subscribe a callback function to one or more channels, and also start a thread to handle new messages. All
+        message and request handlers using the same connection pool share a single redis subscriber. By default,
+        ignores SICRequests.
         :param callback: a function expecting a SICMessage and a channel argument to process the messages received on `channel`
         :param channels: channel or channels to listen to
         :param ignore_requests: Flag to control whether the message handler should also trigger the callback if the
@@ -151,47 +332,33 @@ class SICRedis:
 
         assert len(channels), "Must provide at least one channel"
 
-        # ignore subscribers messages as to not trigger the callback with useless information
-        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
-
         # unpack pubsub message to SICMessage
         def wrapped_callback(pubsub_msg):
             try:
-                sic_message = self.parse_pubsub_message(pubsub_msg)
-
-                if ignore_requests and is_sic_instance(sic_message, SICRequest):
+                if ignore_requests and self._is_request(pubsub_msg):
                     return
 
+                sic_message = self.parse_pubsub_message(pubsub_msg)
+
                 return callback(sic_message)
             except Exception as e:
                 # Errors in a remote thread fail silently, so explicitly catch anything and log to the user.
+                # The handler thread keeps running to handle the next message.
                 if self.parent_logger:
                     self.parent_logger.exception(e)
-                raise e
+                else:
+                    traceback.print_exc()
 
         channels = [utils.str_if_bytes(c) for c in channels]
 
-        pubsub.subscribe(**{c: wrapped_callback for c in channels})
-
-        def exception_handler(e, pubsub, thread):
-            # Ignore the exception if the main program is already stopping (which trigger ValueErrors)
-            if not self.stopping:
-                raise e
-
-        # sleep_time is how often the thread checks if the connection is still alive (and checks the stop condition),
-        # if it is 0.0 it can never time out. It can receive messages much faster, so lets be nice to the CPU with 0.1.
-        if six.PY3:
-            thread = pubsub.run_in_thread(
-                sleep_time=0.1, daemon=False, exception_handler=exception_handler
-            )
-        else:
-            # python2 does not support exception handler, but it's not as important to provide a clean exit on the robots
-            thread = pubsub.run_in_thread(sleep_time=0.1, daemon=False)
-
+        thread = HandlerThread(wrapped_callback)
         if self.service_name:
             thread.name = "{}_callback_thread".format(self.service_name)
+        thread.start()
+
+        pubsub = _get_dispatcher(self._redis.connection_pool).register(channels, thread)
 
-        c = CallbackThread(callback, pubsub=pubsub, thread=thread)
+        c = CallbackThread(callback, pubsub=pubsub, thread=thread, channels=channels)
         self._running_callbacks.append(c)
 
         return c
@@ -203,45 +370,102 @@ class SICRedis:
         :param callback_thread: The CallbackThread to unregister
         """
 
-        callback_thread.pubsub.unsubscribe()
-        callback_thread.thread.stop()
+        self._stop_callback(callback_thread)
         self._running_callbacks.remove(callback_thread)
 
+    def _stop_callback(self, callback_thread):
+        # shared pubsub, only unsubscribe this handler
+        _get_dispatcher(self._redis.connection_pool).unregister(
+            callback_thread.channels, callback_thread.thread
+        )
+        callback_thread.thread.stop()
+
     def send_message(self, channel, message):
         """
         Send a SICMessage to a service/device listening on the channel.
         :param channel: The redis pubsub channel to communicate on.
         :param message: The message
-        :return: The number of subscribers that received the message.
+        :return: The number of subscribers that received the message, or None if sent in a pipeline.
         """
         assert isinstance(
             message, SICMessage
         ), "Message must inherit from SICMessage (got {})".format(type(message))
 
-        return self._redis.publish(channel, message.serialize())
+        if is_sic_instance(message, SICRequest):
+            data = message.serialize() + REQUEST_TAG
+        else:
+            data = message.serialize() + MESSAGE_TAG
+
+        pipe = getattr(_pipelines, "pipe", None)
+        if pipe is not None and pipe.connection_pool is self._redis.connection_pool:
+            pipe.publish(channel, data)
+            return None
+
+        return self._redis.publish(channel, data)
 
-    def _reply(self, channel, request, reply):
+    @contextmanager
+    def pipeline(self):
         """
-        Send a reply to a specific request. This is done by sending a SICMessage to the same channel, where
-        the requesting thread/client is waiting for the reply.
-        :param channel: The redis pubsub channel to communicate on.
+        Buffer all messages sent by the calling thread and send them to redis in a single round trip on exit. This
+        includes messages sent by other SICRedis instances using the same connection pool, e.g. by components that
+        are stopped from this thread. Other threads are not affected. Requests are not buffered, as the thread has to
+        wait for their reply.
+
+        Usage:
+            with r.pipeline():
+                r.send_message("a", SICMessage())
+                r.send_message("b", SICMessage())
+
+        :return: The underlying redis pipeline
+        """
+        previous = getattr(_pipelines, "pipe", None)
+        pipe = self._redis.pipeline(transaction=False)
+        _pipelines.pipe = pipe
+        try:
+            yield pipe
+        finally:
+            _pipelines.pipe = previous
+            pipe.execute()
+
+    def _reply(self, channel, request, reply, untagged=False):
+        """
+        Send a reply to a specific request. The reply is pushed onto a redis list that is unique to the request,
+        where the requesting thread/client is waiting for the reply.
+        :param channel: The redis pubsub channel the request was received on.
         :param request: The SICRequest
         :param reply: The SICMessage reply to send back to the requesting client.
+        :param untagged: True if the request was sent without a tag, by a SIC version before 2.1.0.
         """
         # auto-reply to the request if the request id is not set. Used for example when a service manager
         # does not want to reply to a request, so a reply is returned but its not a reply to the request
         if reply._request_id is None:
             reply._request_id = request._request_id
-        self.send_message(channel, reply)
+
+        # nobody is waiting for a reply that is not a reply to the request
+        if reply._request_id != request._request_id:
+            return
+
+        if untagged:
+            # older clients wait for the reply on the channel of the request
+            self.send_message(channel, reply)
+            return
+
+        # expire the reply in case the requesting client is no longer waiting for it
+        key = self._get_reply_key(request._request_id)
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.lpush(key, reply.serialize())
+        pipe.expire(key, self.REPLY_EXPIRE_TIME)
+        pipe.execute()
 
     def request(self, channel, request, timeout=5, block=True):
         """
-        Send a request, and wait for the reply on the same channel. If the reply takes longer than
+        Send a request, and wait for the reply. If the reply takes longer than
         `timeout` seconds to arrive, a TimeoutError is raised. If block is set to false, the reply is
         ignored and the function returns immediately.
         :param channel: The redis pubsub channel to communicate on.
         :param request: The SICRequest
-        :param timeout: Timeout in seconds in case the reply takes too long.
+        :param timeout: Timeout in seconds in case the reply takes too long, must be larger than 0. Fractions of a
+                        second require redis server 6 or newer.
         :param block: If false, immediately returns None after sending the request.
         :return: the SICMessage reply
         """
@@ -251,57 +475,64 @@ class SICRedis:
                 "Invalid request id for request {}".format(request.get_message_name())
             )
 
-        # Set up a callback to listen to the same channel, where we expect the reply.
-        # Once we have the reply the queue passes the data back to this thread and the
-        # event signals we have received the reply. Subscribe first, as to not miss it
-        # if the reply is faster than our subscription.
-        done = threading.Event()
-        q = queue.Queue(1)
-
-        def await_reply(reply):
-            # If not our own request but is a SICMessage with the right id, then it is the reply
-            # we are waiting for
-            if (
-                not is_sic_instance(reply, SICRequest)
-                and reply._request_id == request._request_id
-            ):
-                q.put(reply)
-                done.set()
-
-        if block:
-            callback_thread = self.register_message_handler(channel, await_reply)
-
-        self.send_message(channel, request)
+        # publish directly instead of with send_message, such that a request made inside a pipeline() is not held
+        # back until after we stopped waiting for its reply
+        self._redis.publish(channel, request.serialize() + REQUEST_TAG)
 
         if not block:
             return None
 
-        else:
-
-            done.wait(timeout)
+        # The reply is pushed to a list for this request only, so we can block on it without subscribing to the
+        # channel first. A list also keeps the reply if it arrives before we start waiting.
+        reply = self._redis.blpop(
+            [self._get_reply_key(request._request_id)], timeout=timeout
+        )
 
-            if not done.is_set():
-                raise TimeoutError(
-                    "Waiting for reply to {} to request timed out".format(
-                        request.get_message_name()
+        if reply is None:
+            message = "Waiting for reply to {} to request timed out".format(
+                request.get_message_name()
+            )
+            # SIC versions before 2.1.0 publish their reply on the channel instead of pushing it to the reply list,
+            # which looks exactly like a handler that does not reply
+            if self._redis.pubsub_numsub(channel)[0][1] > 0:
+                message += (
+                    " (a handler is listening on {}, is the device running an older, incompatible version of "
+                    "social-interaction-cloud? All devices need version {} or newer)".format(
+                        channel, MIN_COMPATIBLE_VERSION
                     )
                 )
+            raise TimeoutError(message)
 
-            # cleanup by unsubscribing and stopping the subscriber thread
-            self.unregister_callback(callback_thread)
+        return SICMessage.deserialize(reply[1])
 
-            return q.get()
+    @staticmethod
+    def _get_reply_key(request_id):
+        """
+        Get the redis key of the list the reply to a request is pushed to.
+        :param request_id: The id of the SICRequest
+        :return: key name
+        :rtype: str
+        """
+        return "sic:reply:{}".format(request_id)
 
-    def register_request_handler(self, channel, callback):
+    def register_request_handler(self, channel, callback, concurrent=False):
         """
         Register a function to listen to SICRequest's (and ignore SICMessages). Handler must return a SICMessage as a reply.
-        Will block receiving new messages until the callback is finished.
+        Will block receiving new messages until the callback is finished, unless concurrent is set. All message and
+        request handlers using the same connection pool share a single redis subscriber.
         :param channel: The redis pubsub channel to communicate on.
         :param callback: function to run upon receiving a SICRequest. Must return a SICMessage reply
+        :param concurrent: If true, every request is handled in its own thread, so a slow request does not delay
+                           the replies to the requests after it. The callback must be thread safe.
         """
 
-        def wrapped_callback(request):
-            if is_sic_instance(request, SICRequest):
+        def wrapped_callback(pubsub_msg):
+            try:
+                if not self._is_request(pubsub_msg):
+                    return
+
+                request = self.parse_pubsub_message(pubsub_msg)
+
                 reply = callback(request)
 
                 assert not is_sic_instance(reply, SICRequest) and is_sic_instance(
@@ -311,12 +542,33 @@ class SICRedis:
                     "received: {}".format(type(reply))
                 )
 
-                self._reply(channel, request, reply)
+                self._reply(
+                    channel, request, reply, untagged=self._is_untagged(pubsub_msg)
+                )
+            except Exception as e:
+                # Errors in a remote thread fail silently, so explicitly catch anything and log to the user.
+                # The handler thread keeps running to handle the next request.
+                if self.parent_logger:
+                    self.parent_logger.exception(e)
+                else:
+                    traceback.print_exc()
+
+        channel = utils.str_if_bytes(channel)
+
+        thread = HandlerThread(wrapped_callback, concurrent=concurrent)
+        if self.service_name:
+            thread.name = "{}_request_handler_thread".format(self.service_name)
+        thread.start()
 
-        return self.register_message_handler(
-            channel, wrapped_callback, ignore_requests=False
+        pubsub = _get_dispatcher(self._redis.connection_pool).register(
+            [channel], thread
         )
 
+        c = CallbackThread(callback, pubsub=pubsub, thread=thread, channels=[channel])
+        self._running_callbacks.append(c)
+
+        return c
+
     def time(self):
         return self._redis.time()
 
@@ -326,8 +578,7 @@ class SICRedis:
         """
         self.stopping = True
         for c in self._running_callbacks:
-            c.pubsub.unsubscribe()
-            c.thread.stop()
+            self._stop_callback(c)
         self._redis.close()
 
     def __del__(self):
@@ -350,11 +601,60 @@ class SICRedis:
         )
 
         if type_ == "message":
+            # the message tag after the pickled message is ignored by pickle
             message = SICMessage.deserialize(data)
             return message
 
         return None
 
+    def _is_request(self, pubsub_msg):
+        """
+        Check if a redis pub/sub message contains a SICRequest, without unpickling it unless it was sent by an older
+        SIC version that does not tag its messages.
+        :param pubsub_msg:
+        :return: True if the message is a SICRequest
+        """
+        tag = pubsub_msg["data"][-1:]
+        if tag == REQUEST_TAG:
+            return True
+        if tag == MESSAGE_TAG:
+            return False
+
+        self._warn_untagged_once(pubsub_msg)
+        message = self.parse_pubsub_message(pubsub_msg)
+        return is_sic_instance(message, SICRequest)
+
+    @staticmethod
+    def _is_untagged(pubsub_msg):
+        """
+        Check if a redis pub/sub message was sent by an older SIC version, which sends plain pickles.
+        :param pubsub_msg:
+        :return: True if the message has no tag
+        """
+        return pubsub_msg["data"][-1:] not in (MESSAGE_TAG, REQUEST_TAG)
+
+    def _warn_untagged_once(self, pubsub_msg):
+        """
+        Warn the user (once per process) that a device or client is running an older version of SIC.
+        :param pubsub_msg:
+        """
+        global _warned_untagged
+
+        if _warned_untagged:
+            return
+        _warned_untagged = True
+
+        warning = (
+            "Received a message on {} from an older version of social-interaction-cloud, please update all devices "
+            "to version {} or newer.".format(
+                utils.str_if_bytes(pubsub_msg["channel"]), MIN_COMPATIBLE_VERSION
+            )
+        )
+        if self.parent_logger:
+            self.parent_logger.warning(warning)
+        else:
+            print("Warning:", warning)
+
 
 if __name__ == "__main__":
 
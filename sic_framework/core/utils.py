@@ -1,5 +1,6 @@
 import binascii
 import getpass
+import multiprocessing
 import os
 import socket
 import sys
@@ -46,6 +47,16 @@ def ping_server(server, port, timeout=3):
         return True
 
 
+def get_num_cpus():
+    """
+    The number of CPUs this process is allowed to run on, which can be less than the number of CPUs of the device.
+    :return: number of CPUs
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return multiprocessing.cpu_count()
+
+
 def get_username_hostname_ip():
     return getpass.getuser() + "_" + socket.gethostname() + "_" + get_ip_adress()
 